@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Summary tables and a query cache for the analysis queries.
+
+After a load two summary tables are built from the element and tag tables:
+
+    user_edits  (user, num)                       - nodes + ways per user
+    tag_counts  (element_type, key, value, num)   - tags per (key, value)
+
+so "top contributing users" or "count of religious tags" become lookups
+instead of full scans.  Each summary is built in full once, when the database
+has no summary yet; after that multi_region.merge_shard adds each shard's new
+rows to it with add_shard, so a merge never rescans the whole tag tables.
+
+Queries that can't be answered from the summaries go
+through cached_query, which keeps each result in the query_cache table along
+with the version of every table it read.  A load only bumps the version of
+tables it actually added rows to, in the same transaction as the rows, so
+cached results stay valid exactly until the underlying rows change.
+"""
+import json
+import sys
+
+import database
+
+AGGREGATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_edits (
+    user TEXT PRIMARY KEY,
+    num INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tag_counts (
+    element_type TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    num INTEGER NOT NULL,
+    PRIMARY KEY (element_type, key, value)
+);
+
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS query_cache (
+    sql TEXT PRIMARY KEY,
+    versions TEXT NOT NULL,
+    result TEXT NOT NULL
+);
+"""
+
+BASE_TABLES = [table for table, _, _ in database.TABLES]
+
+# Each summary, the base tables it is built from and how to build it in full.
+# A summary counts as built once table_versions has a row with its name.
+AGGREGATES = [
+    ('user_edits', ('nodes', 'ways'), ["DELETE FROM user_edits", """
+        INSERT INTO user_edits (user, num)
+        SELECT e.user, COUNT(*)
+        FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) e
+        GROUP BY e.user"""]),
+    ('tag_counts', ('nodes_tags', 'ways_tags'), ["DELETE FROM tag_counts", """
+        INSERT INTO tag_counts (element_type, key, value, num)
+        SELECT 'node', key, value, COUNT(*) FROM nodes_tags
+        GROUP BY key, value""", """
+        INSERT INTO tag_counts (element_type, key, value, num)
+        SELECT 'way', key, value, COUNT(*) FROM ways_tags
+        GROUP BY key, value"""]),
+]
+
+# Add the rows an attached staging shard is about to contribute to the
+# summaries.  These use the same "not already in the database" filter as
+# multi_region.MERGE_SQL, so they must run before the shard is merged.
+SHARD_DELTA_SQL = [
+    """
+    INSERT INTO main.user_edits (user, num)
+    SELECT e.user, COUNT(*)
+    FROM (SELECT user FROM shard.nodes AS s
+          WHERE NOT EXISTS (SELECT 1 FROM main.nodes AS m WHERE m.id = s.id)
+          UNION ALL
+          SELECT user FROM shard.ways AS s
+          WHERE NOT EXISTS (SELECT 1 FROM main.ways AS m WHERE m.id = s.id)) e
+    GROUP BY e.user
+    ON CONFLICT (user) DO UPDATE SET num = num + excluded.num""",
+    """
+    INSERT INTO main.tag_counts (element_type, key, value, num)
+    SELECT 'node', key, value, COUNT(*) FROM shard.nodes_tags AS s
+    WHERE NOT EXISTS (SELECT 1 FROM main.nodes AS m WHERE m.id = s.id)
+    GROUP BY key, value
+    ON CONFLICT (element_type, key, value) DO UPDATE SET num = num + excluded.num""",
+    """
+    INSERT INTO main.tag_counts (element_type, key, value, num)
+    SELECT 'way', key, value, COUNT(*) FROM shard.ways_tags AS s
+    WHERE NOT EXISTS (SELECT 1 FROM main.ways AS m WHERE m.id = s.id)
+    GROUP BY key, value
+    ON CONFLICT (element_type, key, value) DO UPDATE SET num = num + excluded.num""",
+]
+
+# The notebook queries that can't be read straight off the summary tables
+MCDONALDS_SQL = """
+    SELECT COUNT(*)
+    FROM nodes_tags
+        JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value = 'restaurant'
+              OR value = 'fast_food') AS r
+        ON nodes_tags.id = r.id
+    WHERE nodes_tags.value LIKE '%mcd%'"""
+
+CUISINE_SQL = """
+    SELECT nodes_tags.value, COUNT(*) AS num
+    FROM nodes_tags
+        JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value = 'restaurant') AS r
+        ON nodes_tags.id = r.id
+    WHERE nodes_tags.key = 'cuisine'
+    GROUP BY nodes_tags.value
+    ORDER BY num DESC
+    LIMIT ?"""
+
+
+def _built(conn):
+    if not database.table_exists(conn, 'table_versions'):
+        return set()
+    return set(name for (name,) in conn.execute("SELECT name FROM table_versions"))
+
+
+def has_aggregates(conn):
+    """True if every summary has been built"""
+    built = _built(conn)
+    return all(summary in built for summary, _, _ in AGGREGATES)
+
+
+def create_tables(conn):
+    """Create the summary, version and cache tables if they don't exist yet
+
+    This commits any open transaction, so call it before starting a load.
+    """
+    conn.executescript(AGGREGATE_SCHEMA)
+
+
+def bump_versions(conn, changed):
+    """Bump the version of every table changed says gained rows
+
+    Runs inside the caller's transaction, so the new versions are committed
+    together with the rows.  Returns the tables whose version was bumped.
+    """
+    bumped = [table for table in BASE_TABLES if changed.get(table)]
+    for table in bumped:
+        conn.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)",
+                     (table,))
+        conn.execute("UPDATE table_versions SET version = version + 1 WHERE name = ?",
+                     (table,))
+    return bumped
+
+
+def add_shard(conn):
+    """Add the new rows of the attached staging shard to the summaries"""
+    for sql in SHARD_DELTA_SQL:
+        conn.execute(sql)
+
+
+def build_aggregates(conn, changed=None):
+    """Build any missing summary and bump the version of the changed tables
+
+    changed maps table name to the number of rows a load added to it, as
+    returned by database.import_csvs.  Tables
+    under a summary built here count as changed too.  Returns the tables whose
+    version was bumped.
+    """
+    changed = dict(changed or {})
+    built = _built(conn)
+    create_tables(conn)
+
+    for summary, tables, statements in AGGREGATES:
+        if summary not in built:
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute("INSERT INTO table_versions (name, version) VALUES (?, 0)",
+                         (summary,))
+            for table in tables:
+                changed[table] = changed.get(table) or 1
+
+    bumped = bump_versions(conn, changed)
+    conn.commit()
+
+    return bumped
+
+
+def _versions(conn, tables):
+    versions = dict(conn.execute("SELECT name, version FROM table_versions"))
+    return json.dumps([versions.get(table, 0) for table in tables])
+
+
+def cached_query(conn, sql, tables, params=()):
+    """Run sql, or return its cached rows if none of tables changed since"""
+    key = json.dumps([sql, list(params)])
+    versions = _versions(conn, tables)
+
+    row = conn.execute("SELECT versions, result FROM query_cache WHERE sql = ?",
+                       (key,)).fetchone()
+    if row and row[0] == versions:
+        return [tuple(r) for r in json.loads(row[1])]
+
+    result = conn.execute(sql, params).fetchall()
+    conn.execute("INSERT OR REPLACE INTO query_cache (sql, versions, result) VALUES (?, ?, ?)",
+                 (key, versions, json.dumps(result)))
+    conn.commit()
+
+    return result
+
+
+# ================================================== #
+#               Analysis Queries                     #
+# ================================================== #
+
+def top_users(conn, limit=10):
+    return conn.execute("SELECT user, num FROM user_edits ORDER BY num DESC LIMIT ?",
+                        (limit,)).fetchall()
+
+
+def tag_value_counts(conn, key, element_types=('node', 'way'), limit=10):
+    """Count of each value for key, summed over element_types"""
+    sql = """
+        SELECT value, SUM(num) AS total FROM tag_counts
+        WHERE key = ? AND element_type IN ({})
+        GROUP BY value
+        ORDER BY total DESC
+        LIMIT ?""".format(', '.join('?' * len(element_types)))
+
+    return conn.execute(sql, (key,) + tuple(element_types) + (limit,)).fetchall()
+
+
+def mcdonalds_count(conn):
+    return cached_query(conn, MCDONALDS_SQL, ['nodes_tags'])[0][0]
+
+
+def cuisine_counts(conn, limit=10):
+    return cached_query(conn, CUISINE_SQL, ['nodes_tags'], (limit,))
+
+
+def aggregates_main(db_path):
+    conn = database.connect(db_path)
+    build_aggregates(conn)
+
+    print "Top contributing users:"
+    for user, num in top_users(conn):
+        print "  {:<20} {}".format(user, num)
+
+    print "\nReligions:"
+    for value, num in tag_value_counts(conn, 'religion', limit=3):
+        print "  {:<20} {}".format(value, num)
+
+    print "\nCuisines:"
+    for value, num in cuisine_counts(conn):
+        print "  {:<20} {}".format(value, num)
+
+    print "\nMcDonalds: {}".format(mcdonalds_count(conn))
+    conn.close()
+
+
+if __name__ == '__main__':
+    aggregates_main(sys.argv[1] if len(sys.argv) > 1 else database.DB_PATH)
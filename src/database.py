@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Create the SQLite database and import the CSV files written by final_data.py.
+
+The table layout mirrors the field order in final_data.py, so each CSV can be
+inserted column for column.
+"""
+import csv
+import os
+import sqlite3
+
+import final_data
+
+DB_PATH = "osm.db"
+
+SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY NOT NULL,
+    lat REAL,
+    lon REAL,
+    user TEXT,
+    uid INTEGER,
+    version INTEGER,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS nodes_tags (
+    id INTEGER,
+    key TEXT,
+    value TEXT,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES nodes(id)
+);
+
+CREATE TABLE IF NOT EXISTS ways (
+    id INTEGER PRIMARY KEY NOT NULL,
+    user TEXT,
+    uid INTEGER,
+    version TEXT,
+    changeset INTEGER,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ways_tags (
+    id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    type TEXT,
+    FOREIGN KEY (id) REFERENCES ways(id)
+);
+
+CREATE TABLE IF NOT EXISTS ways_nodes (
+    id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    FOREIGN KEY (id) REFERENCES ways(id),
+    FOREIGN KEY (node_id) REFERENCES nodes(id)
+);
+
+CREATE INDEX IF NOT EXISTS nodes_tags_id ON nodes_tags(id);
+CREATE INDEX IF NOT EXISTS ways_tags_id ON ways_tags(id);
+CREATE INDEX IF NOT EXISTS ways_nodes_id ON ways_nodes(id);
+"""
+
+# (table, csv file, column order) in the order they should be imported
+TABLES = [('nodes', final_data.NODES_PATH, final_data.NODE_FIELDS),
+          ('nodes_tags', final_data.NODE_TAGS_PATH, final_data.NODE_TAGS_FIELDS),
+          ('ways', final_data.WAYS_PATH, final_data.WAY_FIELDS),
+          ('ways_tags', final_data.WAY_TAGS_PATH, final_data.WAY_TAGS_FIELDS),
+          ('ways_nodes', final_data.WAY_NODES_PATH, final_data.WAY_NODES_FIELDS)]
+
+
+def connect(db_path=DB_PATH):
+    """Open the database, creating the tables if they don't exist yet"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SQL_SCHEMA)
+    return conn
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+
+def read_rows(csv_path, fields):
+    """Yield each CSV row as a tuple of unicode values in column order"""
+    with open(csv_path, 'rb') as f:
+        for row in csv.DictReader(f):
+            yield tuple(row[k].decode('utf-8') for k in fields)
+
+
+def import_csvs(conn, csv_dir=''):
+    """Bulk insert every CSV in csv_dir into its matching table
+
+    Returns the rows added per table.  Refuses a database that already has
+    summary tables (see aggregates.py), as those would go stale; add more
+    extracts to it with multi_region.py instead.
+    """
+    if table_exists(conn, 'table_versions'):
+        raise ValueError("Database already has summary tables, "
+                         "use multi_region.py to add more data to it")
+
+    added = {}
+    for table, csv_file, fields in TABLES:
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            table, ', '.join(fields), ', '.join('?' * len(fields)))
+        added[table] = conn.executemany(
+            sql, read_rows(os.path.join(csv_dir, csv_file), fields)).rowcount
+    conn.commit()
+
+    return added
+
+
+if __name__ == '__main__':
+    # Imported here as aggregates itself imports this module
+    import aggregates
+
+    conn = connect(DB_PATH)
+    aggregates.build_aggregates(conn, import_csvs(conn))
+    conn.close()
@@ -62,6 +62,7 @@ The final return value for a "way" element should look something like:
 
 import csv
 import codecs
+import os
 import pprint
 import re
 import xml.etree.cElementTree as ET
@@ -70,6 +71,7 @@ import string
 import cerberus
 
 import schema
+from repair_postcode import PostcodeRepair, WayCentroids, CORRECTPOSTCODE, node_location
 
 OSM_PATH = "manchester_england.osm"
 
@@ -107,6 +109,8 @@ mapping = { "St": "Street",
             "Rd" : "Road"
             }
 
+# Only used when postcode repair is off, otherwise elements are checked
+# against the nearest reference postcodes instead
 invalid_postcode_distance = ['M60 4EP', 'M19 2SY', 'M15 6FD', 'SK5 6XD', 'M17 1TD']
 invalid_street_names = ['Avenuehttps://streaming.media.ccc.de/33c3/']
 
@@ -115,6 +119,10 @@ postcode_re = re.compile(postcode_regex)
 
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
+# Set by process_map when postcode repair is switched on
+postcode_repairer = None
+way_centroids = None
+
 """Clean and shape node or way XML element to Python dict"""
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
@@ -138,9 +146,10 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
                     attribs[k] = default_val('node', k)
         #Set tag elements
         _id = element.attrib['id']
+        location = element_location(element)
         for tag in element.iter("tag"):
             if not problem_chars.search(tag.attrib['k']):
-                new_tag = parse_tags(tag.attrib, _id, default_tag_type)
+                new_tag = parse_tags(tag.attrib, _id, default_tag_type, location)
                 if new_tag: tags.append(new_tag)
         
         
@@ -162,12 +171,14 @@ def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIE
 #               Data Cleaning Functions              #
 # ================================================== #
 
-def format_postcode(postcode):
+def format_postcode(postcode, location=None):
     postcode_altered = postcode
     postcode_altered = postcode_altered.upper()
     
-    if is_valid_post(postcode_altered):
-        if postcode_altered in invalid_postcode_distance:
+    if postcode_repairer and location:
+        postcode_altered = postcode_repairer.repair(postcode_altered, *location)
+    elif is_valid_post(postcode_altered):
+        if not postcode_repairer and postcode_altered in invalid_postcode_distance:
             postcode_altered = None
     else:
         postcode_altered = None
@@ -235,7 +246,16 @@ def default_val(nodeval, attrib):
 
 
 
-def parse_tags(tags_dict, node_id, default_tag_type):
+#Return the (lat, lon) of a node, or the centre of a way's nodes if known
+def element_location(element):
+    if element.tag == 'node':
+        return node_location(element)
+    if way_centroids:
+        return way_centroids.centroid(element)
+    return None
+
+
+def parse_tags(tags_dict, node_id, default_tag_type, location=None):
     tags = {}
 
     tags['id'] = node_id
@@ -255,7 +275,7 @@ def parse_tags(tags_dict, node_id, default_tag_type):
         tags['value'] = format_street(tags['value'])
 
     if is_post_tag(tags_dict):
-        tags['value'] = format_postcode(tags['value'])
+        tags['value'] = format_postcode(tags['value'], location)
     
     if tags['value'] == None:
             tags = None
@@ -300,14 +320,21 @@ class UnicodeDictWriter(csv.DictWriter, object):
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
-def process_map(file_in, validate):
-    """Iteratively process each XML element and write to csv(s)"""
+def process_map(file_in, validate, out_dir='', repair_postcodes=False):
+    """Iteratively process each XML element and write to csv(s) in out_dir"""
+    global postcode_repairer, way_centroids
+    if repair_postcodes:
+        if postcode_repairer is None:
+            postcode_repairer = PostcodeRepair(CORRECTPOSTCODE)
+        way_centroids = WayCentroids(file_in)
+    else:
+        postcode_repairer = way_centroids = None
 
-    with codecs.open(NODES_PATH, 'wb') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'wb') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'wb') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'wb') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'wb') as way_tags_file:
+    with codecs.open(os.path.join(out_dir, NODES_PATH), 'wb') as nodes_file, \
+         codecs.open(os.path.join(out_dir, NODE_TAGS_PATH), 'wb') as nodes_tags_file, \
+         codecs.open(os.path.join(out_dir, WAYS_PATH), 'wb') as ways_file, \
+         codecs.open(os.path.join(out_dir, WAY_NODES_PATH), 'wb') as way_nodes_file, \
+         codecs.open(os.path.join(out_dir, WAY_TAGS_PATH), 'wb') as way_tags_file:
 
         nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
         node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
@@ -324,6 +351,8 @@ def process_map(file_in, validate):
         validator = cerberus.Validator()
         
         for element in get_element(file_in, tags=('node', 'way')):
+            if way_centroids and element.tag == 'node':
+                way_centroids.add_node(element)
             el = shape_element(element)
 
             if el:
@@ -345,5 +374,5 @@ def process_map(file_in, validate):
 if __name__ == '__main__':
     # Note: Validation is ~ 10X slower. For the project consider using a small
     # sample of the map when validating.
-    process_map(OSM_PATH, validate=False)
+    process_map(OSM_PATH, validate=False, repair_postcodes=True)
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Process several neighbouring OSM extracts at once and merge them into one
+database.
+
+Each extract is shaped by final_data.process_map in its own worker process,
+writing its CSVs and a staging SQLite shard into STAGING_DIR/<n>_<region>.  Once
+all workers are done the shards are merged into the main database one at a
+time.  Neighbouring extracts overlap, so elements are deduplicated on id: an
+element already in the database is skipped together with its tags and way
+nodes, so shared elements are never counted twice.  Each shard directory is
+removed once it has been merged.
+
+Usage:
+    python multi_region.py manchester.osm liverpool.osm leeds.osm
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+import aggregates
+import database
+import final_data
+
+STAGING_DIR = "staging"
+
+# Child tables are merged before their parent so the "not already in the
+# database" check still sees the parent ids as they were before this shard.
+MERGE_SQL = [
+    ('nodes_tags', """
+        INSERT INTO main.nodes_tags (id, key, value, type)
+        SELECT id, key, value, type FROM shard.nodes_tags AS s
+        WHERE NOT EXISTS (SELECT 1 FROM main.nodes AS m WHERE m.id = s.id)"""),
+    ('nodes', """
+        INSERT OR IGNORE INTO main.nodes
+        SELECT * FROM shard.nodes"""),
+    ('ways_tags', """
+        INSERT INTO main.ways_tags (id, key, value, type)
+        SELECT id, key, value, type FROM shard.ways_tags AS s
+        WHERE NOT EXISTS (SELECT 1 FROM main.ways AS m WHERE m.id = s.id)"""),
+    ('ways_nodes', """
+        INSERT INTO main.ways_nodes (id, node_id, position)
+        SELECT id, node_id, position FROM shard.ways_nodes AS s
+        WHERE NOT EXISTS (SELECT 1 FROM main.ways AS m WHERE m.id = s.id)"""),
+    ('ways', """
+        INSERT OR IGNORE INTO main.ways
+        SELECT * FROM shard.ways"""),
+]
+
+
+def region_name(osm_file):
+    return os.path.splitext(os.path.basename(osm_file))[0]
+
+
+def process_region(osm_file, staging_dir=STAGING_DIR, index=0):
+    """Shape one extract into its own staging shard, return (region, shard, seconds)
+
+    index keeps the shard directory unique when two extracts share a file name.
+    Errors are raised as a RuntimeError naming osm_file, so the caller can tell
+    which extract failed and the error survives the trip back from the worker.
+    """
+    try:
+        return _process_region(osm_file, staging_dir, index)
+    except Exception as e:
+        raise RuntimeError("Failed to process {}: {}: {}".format(
+            osm_file, type(e).__name__, e))
+
+
+def _process_region(osm_file, staging_dir, index):
+    start = time.time()
+
+    region = region_name(osm_file)
+    shard_dir = os.path.join(staging_dir, "{}_{}".format(index, region))
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    final_data.process_map(osm_file, validate=False, out_dir=shard_dir,
+                           repair_postcodes=True)
+
+    shard_path = os.path.join(shard_dir, database.DB_PATH)
+    if os.path.exists(shard_path):
+        os.remove(shard_path)
+    conn = database.connect(shard_path)
+    database.import_csvs(conn, shard_dir)
+    conn.close()
+
+    return region, shard_path, time.time() - start
+
+
+def _process_region_star(args):
+    return process_region(*args)
+
+
+def merge_shard(conn, shard_path):
+    """Merge one staging shard into conn, return the rows added per table
+
+    Summaries that are already built get the shard's new rows added to them,
+    and the versions of the tables that gained rows are bumped before the
+    merge is committed, so cached queries never outlive the rows they read.
+    """
+    added = {}
+    update_summaries = aggregates.has_aggregates(conn)
+    aggregates.create_tables(conn)
+    conn.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+    try:
+        if update_summaries:
+            aggregates.add_shard(conn)
+        for table, sql in MERGE_SQL:
+            added[table] = conn.execute(sql).rowcount
+        aggregates.bump_versions(conn, added)
+        conn.commit()
+    except:
+        # The shard can't be detached while this merge's transaction is open
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE shard")
+
+    return added
+
+
+def process_regions(osm_files, db_path=database.DB_PATH, workers=None,
+                    staging_dir=STAGING_DIR):
+    """Process osm_files concurrently and merge every shard into db_path"""
+    if not osm_files:
+        raise ValueError("No OSM files to process")
+    if workers is None:
+        workers = min(len(osm_files), multiprocessing.cpu_count())
+
+    start = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        shards = pool.map(_process_region_star,
+                          [(osm_file, staging_dir, index)
+                           for index, osm_file in enumerate(osm_files)])
+    finally:
+        pool.close()
+        pool.join()
+    process_time = time.time() - start
+
+    print "\nRegion processing ({} workers):".format(workers)
+    for region, shard_path, seconds in shards:
+        print "  {:<20} {:>8.1f} s".format(region, seconds)
+    print "  {:<20} {:>8.1f} s".format("wall clock", process_time)
+
+    totals = {}
+    conn = database.connect(db_path)
+    print "\nMerging shards into {}:".format(db_path)
+    for region, shard_path, _ in shards:
+        merge_start = time.time()
+        added = merge_shard(conn, shard_path)
+        for table, rows in added.items():
+            totals[table] = totals.get(table, 0) + rows
+
+        shutil.rmtree(os.path.dirname(shard_path))
+
+        print "  {:<20} {:>8.1f} s  nodes +{}  ways +{}".format(
+            region, time.time() - merge_start, added['nodes'], added['ways'])
+
+    # Each merge already invalidated its cached queries, this only builds
+    # summaries the database didn't have yet
+    aggregate_start = time.time()
+    aggregates.build_aggregates(conn)
+    print "  {:<20} {:>8.1f} s".format("aggregates", time.time() - aggregate_start)
+    conn.close()
+
+    print "\nTotal time {:.1f} s".format(time.time() - start)
+    return totals
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+
+    process_regions(sys.argv[1:])
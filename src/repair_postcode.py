@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Repair truncated and misplaced postcodes using the nearest reference postcode.
+
+Reference postcode centroids (correct_postcodes.csv, or the full national
+postcode lookup in the same Postcode,lat,lon format) are bucketed into a grid
+of CELL_SIZE degree cells, one grid per outward code ("M23", "SK5", ...).
+A lookup only searches the rings of cells around the element until no closer
+postcode can exist, so it stays well under a millisecond even with the full
+national table loaded.
+
+The distance threshold is worked out per postcode rather than kept as a fixed
+list: it is DENSITY_FACTOR times the distance from the postcode's centroid to
+its DENSITY_NEIGHBOURS-th nearest neighbour, kept between MIN_THRESHOLD_KM and
+MAX_THRESHOLD_KM (the half kilometre used in the original audit).  Only the
+full national table is dense enough for this to tighten the limit in city
+centres.  correct_postcodes.csv holds just the ~550 postcodes found in the
+Manchester extract, too far apart to say anything about density, so with it
+almost every postcode simply gets the 0.5 km cap.
+
+Ways have no coordinates of their own, so they are located at the centre of
+their nodes.  WayCentroids finds the nodes used by postcode-tagged ways in a
+first pass and keeps only their coordinates while the file is processed,
+which works because an OSM file lists every node before the ways.
+
+Running this file prints the proposed corrections for OSMFILE without
+changing anything.  final_data.py applies them when shaping the CSVs.
+"""
+import csv
+import math
+import re
+import xml.etree.cElementTree as ET
+from collections import defaultdict
+
+OSMFILE = "manchester_england.osm"
+CORRECTPOSTCODE = "correct_postcodes.csv"
+
+EARTH_RADIUS_KM = 6371.0
+CELL_SIZE = 0.01
+DENSITY_NEIGHBOURS = 3
+DENSITY_FACTOR = 4.0
+MIN_THRESHOLD_KM = 0.25
+MAX_THRESHOLD_KM = 0.5
+
+full_postcode_re = re.compile(r'^([A-Z]{1,2}[0-9]{1,2}[A-Z]?) ?([0-9][A-Z]{2})$')
+partial_postcode_re = re.compile(r'^([A-Z]{1,2}[0-9]{1,2}[A-Z]?)(?: ([0-9][A-Z]?))?$')
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Equirectangular distance, accurate to a few metres at postcode scale"""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_KM * math.hypot(x, y)
+
+
+def split_postcode(postcode):
+    """Return (outward, inward, is_full) for a full or truncated postcode
+
+    'M1 1AA' -> ('M1', '1AA', True), 'SK5 7' -> ('SK5', '7', False),
+    'M23' -> ('M23', '', False).  Returns None if it isn't either.
+    """
+    postcode = ' '.join(postcode.upper().split())
+
+    m = full_postcode_re.search(postcode)
+    if m:
+        return m.group(1), m.group(2), True
+
+    m = partial_postcode_re.search(postcode)
+    if m:
+        return m.group(1), m.group(2) or '', False
+
+    return None
+
+
+class PostcodeGrid(object):
+    """Grid index over postcode centroids for nearest neighbour lookups"""
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.min_cell = None
+        self.max_cell = None
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def add(self, postcode, lat, lon):
+        cell = self._cell(lat, lon)
+        self.cells[cell].append((postcode, lat, lon))
+
+        if self.min_cell is None:
+            self.min_cell, self.max_cell = cell, cell
+        else:
+            self.min_cell = (min(self.min_cell[0], cell[0]), min(self.min_cell[1], cell[1]))
+            self.max_cell = (max(self.max_cell[0], cell[0]), max(self.max_cell[1], cell[1]))
+
+    def _ring(self, row, col, r):
+        """Yield the cells exactly r steps away from (row, col)"""
+        if r == 0:
+            yield row, col
+            return
+        for dc in range(-r, r + 1):
+            yield row - r, col + dc
+            yield row + r, col + dc
+        for dr in range(-r + 1, r):
+            yield row + dr, col - r
+            yield row + dr, col + r
+
+    def nearest(self, lat, lon, k=1, prefix='', exclude=None, max_km=None):
+        """Return up to k (distance_km, postcode) tuples nearest to lat/lon
+
+        Only postcodes starting with prefix are considered, and exclude is
+        skipped so a postcode can look up its own neighbours.  With max_km set,
+        the search stops at that radius and nothing further away is returned.
+        """
+        if self.min_cell is None:
+            return []
+
+        row, col = self._cell(lat, lon)
+        max_r = max(abs(row - self.min_cell[0]), abs(row - self.max_cell[0]),
+                    abs(col - self.min_cell[1]), abs(col - self.max_cell[1]))
+
+        # Anything outside ring r is at least r cells away along one axis, and
+        # a degree of longitude is the shorter of the two.
+        cell_km = math.radians(self.cell_size) * EARTH_RADIUS_KM * math.cos(math.radians(lat))
+
+        found = []
+        for r in range(max_r + 1):
+            for cell in self._ring(row, col, r):
+                for postcode, plat, plon in self.cells.get(cell, ()):
+                    if postcode == exclude or not postcode.startswith(prefix):
+                        continue
+                    found.append((distance_km(lat, lon, plat, plon), postcode))
+
+            if len(found) >= k:
+                found.sort()
+                del found[k:]
+                if found[-1][0] <= r * cell_km:
+                    break
+
+            if max_km is not None and r * cell_km > max_km:
+                break
+
+        found.sort()
+        if max_km is not None:
+            found = [f for f in found if f[0] <= max_km]
+        return found[:k]
+
+
+class PostcodeRepair(object):
+    """Propose corrections for truncated or misplaced postcodes"""
+
+    def __init__(self, datafile=CORRECTPOSTCODE):
+        self.centroids = {}
+        self.everything = PostcodeGrid()
+        self.by_outward = defaultdict(PostcodeGrid)
+        self._thresholds = {}
+
+        with open(datafile, 'rb') as f:
+            csvreader = csv.reader(f)
+            next(csvreader)
+
+            for row in csvreader:
+                parts = split_postcode(row[0])
+                if not parts or not parts[2]:
+                    continue
+                postcode = "{} {}".format(parts[0], parts[1])
+                lat, lon = float(row[1]), float(row[2])
+
+                self.centroids[postcode] = (lat, lon)
+                self.everything.add(postcode, lat, lon)
+                self.by_outward[parts[0]].add(postcode, lat, lon)
+
+    def threshold(self, postcode):
+        """Furthest an element may be from postcode's centroid, in km"""
+        if postcode not in self._thresholds:
+            lat, lon = self.centroids[postcode]
+            # Neighbours further than this would only give the capped threshold
+            neighbours = self.everything.nearest(lat, lon, k=DENSITY_NEIGHBOURS,
+                                                 exclude=postcode,
+                                                 max_km=MAX_THRESHOLD_KM / DENSITY_FACTOR)
+            if len(neighbours) == DENSITY_NEIGHBOURS:
+                threshold = max(MIN_THRESHOLD_KM, DENSITY_FACTOR * neighbours[-1][0])
+            else:
+                threshold = MAX_THRESHOLD_KM
+            self._thresholds[postcode] = min(MAX_THRESHOLD_KM, threshold)
+
+        return self._thresholds[postcode]
+
+    def repair(self, postcode, lat, lon):
+        """Return the postcode to use for an element at lat/lon
+
+        A full postcode within its threshold is returned as is, a truncated or
+        misplaced one is replaced by the nearest reference postcode sharing its
+        outward code (and sector, if given).  Returns None when no reference
+        postcode is close enough, and leaves full postcodes missing from the
+        reference data alone as there is nothing to compare against.
+        """
+        parts = split_postcode(postcode)
+        if not parts:
+            return None
+        outward, inward, is_full = parts
+
+        if is_full:
+            postcode = "{} {}".format(outward, inward)
+            if postcode not in self.centroids:
+                return postcode
+
+            clat, clon = self.centroids[postcode]
+            if distance_km(lat, lon, clat, clon) <= self.threshold(postcode):
+                return postcode
+            inward = ''
+
+        if outward not in self.by_outward:
+            return None
+
+        prefix = "{} {}".format(outward, inward) if inward else ''
+        nearest = self.by_outward[outward].nearest(lat, lon, prefix=prefix,
+                                                   max_km=MAX_THRESHOLD_KM)
+        if not nearest:
+            return None
+
+        dist, candidate = nearest[0]
+        if dist <= self.threshold(candidate):
+            return candidate
+
+        return None
+
+
+def iter_elements(osmfile, tags=('node', 'way')):
+    """Yield each matching element, clearing the tree as it goes"""
+    context = ET.iterparse(osmfile, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag in tags:
+            yield elem
+            root.clear()
+
+
+def has_postcode(elem):
+    return any(tag.attrib['k'] == "addr:postcode" for tag in elem.iter("tag"))
+
+
+def node_location(elem):
+    lat, lon = elem.attrib.get('lat'), elem.attrib.get('lon')
+    if lat and lon:
+        return float(lat), float(lon)
+    return None
+
+
+class WayCentroids(object):
+    """Locate postcode-tagged ways from the coordinates of their nodes"""
+
+    def __init__(self, osmfile):
+        self.wanted = set()
+        self.coords = {}
+
+        for elem in iter_elements(osmfile, tags=('way',)):
+            if has_postcode(elem):
+                self.wanted.update(nd.attrib['ref'] for nd in elem.iter("nd"))
+
+    def add_node(self, elem):
+        """Remember elem's coordinates if a postcode-tagged way uses it"""
+        if elem.attrib['id'] in self.wanted:
+            location = node_location(elem)
+            if location:
+                self.coords[elem.attrib['id']] = location
+
+    def centroid(self, elem):
+        """Mean position of the way's known nodes, or None if none are known"""
+        refs = [nd.attrib['ref'] for nd in elem.iter("nd")]
+        if len(refs) > 1 and refs[0] == refs[-1]:
+            refs.pop()
+
+        points = [self.coords[ref] for ref in refs if ref in self.coords]
+        if not points:
+            return None
+
+        return (sum(lat for lat, _ in points) / len(points),
+                sum(lon for _, lon in points) / len(points))
+
+
+def audit_repairs(osmfile, repairer):
+    """Return {(original, proposed): count} for every postcode that would change"""
+    proposals = defaultdict(int)
+    way_centroids = WayCentroids(osmfile)
+
+    for elem in iter_elements(osmfile):
+        if elem.tag == "node":
+            way_centroids.add_node(elem)
+            location = node_location(elem)
+        else:
+            location = way_centroids.centroid(elem)
+
+        for tag in elem.iter("tag"):
+            if tag.attrib['k'] == "addr:postcode" and location:
+                original = tag.attrib['v']
+                proposed = repairer.repair(original, *location)
+                if proposed != original:
+                    proposals[(original, proposed)] += 1
+
+    return proposals
+
+
+def repair_postcode_main():
+    repairer = PostcodeRepair(CORRECTPOSTCODE)
+    proposals = audit_repairs(OSMFILE, repairer)
+
+    print "Proposed postcode repairs:"
+    for (original, proposed), count in sorted(proposals.items()):
+        print "  {} -> {} ({})".format(original, proposed, count)
+
+
+if __name__ == '__main__':
+    repair_postcode_main()